@@ -5,6 +5,7 @@ import logging
 import time
 import json
 import codecs
+import itertools
 from io import StringIO
 
 import lxml
@@ -12,7 +13,9 @@ import packtools
 from packtools.catalogs import XML_CATALOG
 
 import utils
-from tasks import check_registry_status
+from thrift import clients
+from mirror import XMLMirror
+from tasks import check_registry_status, InFlight, PRIORITY_CLASSES
 
 os.environ['XML_CATALOG_FILES'] = XML_CATALOG
 
@@ -83,7 +86,22 @@ def summarize(validator):
     return summary
 
 
-def analyze_xml(xml, document):
+def extract_metadata(validator):
+    """Extracts from the XML tree already parsed by the validator the
+    document metadata used by the XML parsing report.
+    """
+    root = validator.lxml.getroot()
+
+    metadata = {}
+    metadata['document_type'] = root.get('article-type')
+
+    years = root.xpath('front/article-meta/pub-date/year/text()')
+    metadata['publication_year'] = years[0].strip()[0:4] if years else None
+
+    return metadata
+
+
+def analyze_xml(xml, code):
     """Analyzes `file` against packtools' XMLValidator.
     """
 
@@ -92,21 +110,25 @@ def analyze_xml(xml, document):
     try:
         xml = packtools.XMLValidator(f, sps_version='sps-1.1')
     except:
-        logger.error('Could not read file %s' % document.publisher_id)
+        logger.error('Could not read file %s' % code)
         summary = {}
         summary['dtd_is_valid'] = False
         summary['sps_is_valid'] = False
         summary['is_valid'] = False
         summary['parsing_error'] = True
+        summary['document_type'] = None
+        summary['publication_year'] = None
         return summary
     else:
         summary = summarize(xml)
+        summary.update(extract_metadata(xml))
         return summary
 
 
 class Export(object):
 
-    def __init__(self, collection, issns=None, full=False, xml_parsing_report=None):
+    def __init__(self, collection, issns=None, full=False, xml_parsing_report=None, xml_mirror=None,
+                 priority='normal', fair=False, max_in_flight=None):
 
         self._articlemeta = utils.articlemeta_server()
         self._scielomanager = utils.scielomanager_server()
@@ -114,21 +136,32 @@ class Export(object):
         self.issns = issns
         self.full = full
         self.xml_parsing_report = codecs.open(xml_parsing_report, 'w', encoding='utf-8') if xml_parsing_report else xml_parsing_report
+        self.xml_mirror = XMLMirror(xml_mirror) if xml_mirror else xml_mirror
+        self.priority = PRIORITY_CLASSES[priority]
+        self.fair = fair
+        self.max_in_flight = max_in_flight
 
     def _write(self, line):
         self.xml_parsing_report.write('%s\r\n' % line)
 
-    def _fmt_json(self, data, xml_result):
+    def _xml(self, identifier):
+
+        if self.xml_mirror:
+            return self.xml_mirror.document(
+                self._articlemeta, identifier.code, identifier.collection)
+
+        return self._articlemeta.document(
+            identifier.code, identifier.collection, fmt='xmlrsps')
+
+    def _fmt_json(self, identifier, xml_result):
 
         fmt = {}
 
-        fmt['code'] = data.publisher_id
-        fmt['collection'] = data.collection_acronym
-        fmt['id'] = '_'.join([data.collection_acronym, data.publisher_id])
-        fmt['document_type'] = data.document_type
-        fmt['publication_year'] = data.publication_date[0:4]
-        fmt['document_type'] = data.document_type
-        fmt['data_version'] = 'legacy' if data.data_model_version == 'html' else 'xml'
+        fmt['code'] = identifier.code
+        fmt['collection'] = identifier.collection
+        fmt['id'] = '_'.join([identifier.collection, identifier.code])
+        # Only documents with version html are selected by ``items``.
+        fmt['data_version'] = 'legacy'
         fmt.update(xml_result)
 
         return json.dumps(fmt)
@@ -137,21 +170,43 @@ class Export(object):
         '''
             This method registry Celery tasks for each document.
         '''
-        for xylose_article, xml in self.items():
-
-            logger.info('Registering %s, %s' % (
-                xylose_article.publisher_id,
-                xylose_article.collection_acronym))
+        in_flight = InFlight(self.max_in_flight) if self.max_in_flight else None
 
-            check_registry_status.delay(
-                self._scielomanager,
-                self._articlemeta,
-                xylose_article,
-                xml
-            )
+        try:
+            for identifier, xml in self.items():
+
+                logger.info('Registering %s, %s' % (
+                    identifier.code,
+                    identifier.collection))
+
+                if in_flight:
+                    in_flight.acquire()
+
+                check_registry_status.apply_async(
+                    args=(
+                        self._scielomanager,
+                        self._articlemeta,
+                        identifier.code,
+                        identifier.collection,
+                        xml
+                    ),
+                    kwargs={
+                        'notify': in_flight.notify_queue if in_flight else None
+                    },
+                    priority=self.priority
+                )
+        finally:
+            if in_flight:
+                in_flight.close()
 
         logger.info('Export finished')
 
+    def log_metrics(self):
+        # SciELO Manager is only called by the Celery workers, which report
+        # their own circuit breaker metrics.
+        logger.info('Circuit breaker metrics for Article Meta: %s' % (
+            json.dumps(self._articlemeta.breaker.metrics())))
+
     def items(self):
 
         extra_filter = json.dumps({"version": 'html'})
@@ -162,29 +217,63 @@ class Export(object):
         if not self.issns:
             self.issns = [None]
 
-        for issn in self.issns:
-            for data in self._articlemeta.documents(
+        if self.fair and self.issns == [None]:
+            self.issns = [identifier.code[0] for identifier in self._articlemeta.journal_identifiers(
+                collection=self.collection)]
+
+        try:
+            if self.xml_mirror:
+                self.xml_mirror.sync(self._articlemeta, self.collection)
+
+            if self.fair:
+                identifiers = utils.round_robin([self._articlemeta.identifiers(
                     collection=self.collection,
                     issn=issn,
-                    extra_filter=extra_filter):
+                    extra_filter=extra_filter) for issn in self.issns])
+            else:
+                identifiers = itertools.chain.from_iterable(self._articlemeta.identifiers(
+                    collection=self.collection,
+                    issn=issn,
+                    extra_filter=extra_filter) for issn in self.issns)
 
-                logger.info('Reading document: %s' % data.publisher_id)
+            for identifier in identifiers:
 
-                xml = self._articlemeta.document(
-                    data.publisher_id, data.collection_acronym, fmt='xmlrsps')
+                logger.info('Reading document: %s' % identifier.code)
+
+                try:
+                    xml = self._xml(identifier)
+                except clients.CircuitOpenError:
+                    raise
+                except clients.ServerError as e:
+                    logger.error(e.message)
+                    continue
 
-                checked_xml = analyze_xml(xml, data)
+                checked_xml = analyze_xml(xml, identifier.code)
 
                 if not checked_xml['is_valid'] and self.xml_parsing_report:
 
-                    self._write(self._fmt_json(data, checked_xml))
+                    self._write(self._fmt_json(identifier, checked_xml))
 
                 if not checked_xml['dtd_is_valid']:
                     logger.warning('Invalid XML for: %s, %s' % (
-                        data.publisher_id, data.collection_acronym))
+                        identifier.code, identifier.collection))
                     continue
 
-                yield (data, xml)
+                yield (identifier, xml)
+        finally:
+            # Keeps the entries mirrored so far when the run is aborted.
+            if self.xml_mirror:
+                self.xml_mirror.save()
+
+
+def _positive_int(value):
+
+    number = int(value)
+
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be 1 or greater')
+
+    return number
 
 
 def main():
@@ -224,6 +313,32 @@ def main():
         help='Full path to the xml parsing report file. If not specified, no report will be produced'
     )
 
+    parser.add_argument(
+        '--xml_mirror',
+        '-m',
+        help='Full path to a local directory used as a mirror of the XML\'s. Only documents changed in Article Meta since the last run are downloaded again'
+    )
+
+    parser.add_argument(
+        '--priority',
+        '-p',
+        default='normal',
+        choices=['high', 'normal', 'low'],
+        help='Priority of the registration tasks in the queue'
+    )
+
+    parser.add_argument(
+        '--fair',
+        action='store_true',
+        help='Interleave the documents of each journal instead of sending one journal after the other'
+    )
+
+    parser.add_argument(
+        '--max_in_flight',
+        type=_positive_int,
+        help='Maximum number of registration tasks sent by this run and not yet finished by the workers'
+    )
+
     parser.add_argument(
         '--logging_level',
         '-l',
@@ -241,6 +356,13 @@ def main():
         issns = utils.ckeck_given_issns(args.issns)
 
     export = Export(
-        args.collection, issns, full=args.full, xml_parsing_report=args.xml_parsing_report)
+        args.collection, issns, full=args.full, xml_parsing_report=args.xml_parsing_report,
+        xml_mirror=args.xml_mirror, priority=args.priority, fair=args.fair,
+        max_in_flight=args.max_in_flight)
 
-    export.run()
+    try:
+        export.run()
+    except clients.CircuitOpenError as e:
+        logger.error('Aborting, upstream server unavailable: %s' % e.message)
+    finally:
+        export.log_metrics()
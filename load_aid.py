@@ -2,12 +2,22 @@
 import argparse
 import logging
 import json
+import threading
+
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
 
 import utils
+from thrift import clients
 
 
 logger = logging.getLogger(__name__)
 
+# Documents waiting in the queue for each worker thread.
+QUEUE_SIZE_PER_WORKER = 10
+
 
 def _config_logging(logging_level='INFO', logging_file=None):
 
@@ -38,31 +48,121 @@ def _config_logging(logging_level='INFO', logging_file=None):
 
 class Export(object):
 
-    def __init__(self, collection, issns=None, output_file=None):
+    def __init__(self, collection, issns=None, output_file=None, workers=1):
 
-        self._articlemeta = utils.articlemeta_server()
-        self._scielomanager = utils.scielomanager_server()
+        # One connection per worker thread, so workers never wait for the pool.
+        pool_size = max(workers, clients.POOL_SIZE)
+        self._articlemeta = utils.articlemeta_server(pool_size=pool_size)
+        self._scielomanager = utils.scielomanager_server(pool_size=pool_size)
         self.collection = collection
         self.issns = issns
+        self.workers = workers
 
-    def run(self):
+    def _load_aid(self, identifier):
+
+        try:
+            self._process(identifier)
+        except clients.CircuitOpenError:
+            raise
+        except Exception as e:
+            logger.error('Error loading AID for %s_%s: %s' % (
+                identifier.collection, identifier.code, e))
+
+    def _process(self, identifier):
+
+        item = self._articlemeta.document(
+            identifier.code, identifier.collection)
+
+        if not item:
+            return
 
-        for item in self.items():
-            if not item.doi:
-                continue
+        logger.debug('Reading document: %s' % item.publisher_id)
+
+        if item.doi:
             aid = self._scielomanager.retrieve_aid_from_doi(item.doi)
-            if aid:
+        else:
+            aid = self._scielomanager.retrieve_aid_from_meta(
+                item.publisher_id[1:10],
+                item.volume,
+                item.publisher_id
+            )
+
+        if aid:
+
+            logger.debug('AID (%s) found for DOI (%s) and PID (%s)' % (
+                aid,
+                item.doi,
+                item.publisher_id)
+            )
+            self._articlemeta.client.set_aid(
+                item.publisher_id, item.collection_acronym, aid)
+
+    def run(self):
 
-                logger.debug('AID (%s) found for DOI (%s) and PID (%s)' % (
-                    aid,
-                    item.doi,
-                    item.publisher_id)
-                )
-                self._articlemeta.client.set_aid(
-                    item.publisher_id, item.collection_acronym, aid)
+        if self.workers > 1:
+            self._run_workers()
+        else:
+            for identifier in self.items():
+                self._load_aid(identifier)
 
         logger.info('Export finished')
 
+    def _run_workers(self):
+        """
+        Distribui os documentos entre ``workers`` threads por meio de uma fila
+        limitada, de modo que apenas alguns documentos por thread aguardem
+        processamento. A recuperação de cada documento é feita pela thread.
+        """
+        queue = Queue(maxsize=self.workers * QUEUE_SIZE_PER_WORKER)
+        errors = []
+
+        def worker():
+            while True:
+                identifier = queue.get()
+
+                if identifier is None:
+                    break
+
+                if errors:
+                    continue
+
+                try:
+                    self._load_aid(identifier)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for identifier in self.items():
+                while not errors:
+                    try:
+                        queue.put(identifier, timeout=1)
+                        break
+                    except Full:
+                        continue
+
+                if errors:
+                    break
+        finally:
+            for _ in threads:
+                queue.put(None)
+
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def log_metrics(self):
+
+        for name, server in [('Article Meta', self._articlemeta), ('SciELO Manager', self._scielomanager)]:
+            logger.info('Circuit breaker metrics for %s: %s' % (
+                name, json.dumps(server.breaker.metrics())))
+
     def items(self):
 
         extra_filter = json.dumps({"aid": {'$exists': 0}})
@@ -71,12 +171,11 @@ class Export(object):
             self.issns = [None]
 
         for issn in self.issns:
-            for data in self._articlemeta.documents(
+            for identifier in self._articlemeta.identifiers(
                     collection=self.collection,
                     issn=issn,
                     extra_filter=extra_filter):
-                logger.debug('Reading document: %s' % data.publisher_id)
-                yield data
+                yield identifier
 
 
 def main():
@@ -97,6 +196,14 @@ def main():
         help='Collection Acronym'
     )
 
+    parser.add_argument(
+        '--workers',
+        '-w',
+        type=int,
+        default=1,
+        help='Number of documents processed concurrently, sharing the pooled thrift connections'
+    )
+
     parser.add_argument(
         '--logging_file',
         '-o',
@@ -119,6 +226,11 @@ def main():
     if len(args.issns) > 0:
         issns = utils.ckeck_given_issns(args.issns)
 
-    export = Export(args.collection, issns)
+    export = Export(args.collection, issns, workers=args.workers)
 
-    export.run()
+    try:
+        export.run()
+    except clients.CircuitOpenError as e:
+        logger.error('Aborting, upstream server unavailable: %s' % e.message)
+    finally:
+        export.log_metrics()
@@ -0,0 +1,191 @@
+# coding: utf-8
+import os
+import io
+import json
+import gzip
+import zlib
+import mmap
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.json'
+OBJECTS_DIR = 'objects'
+FLUSH_EVERY = 100
+
+
+class XMLMirror(object):
+    """
+    Espelho local dos XML's recuperados do Article Meta.
+
+    Os XML's são armazenados comprimidos (gzip) em um diretório particionado
+    pelo hash SHA1 do conteúdo. O arquivo ``index.json`` relaciona cada
+    documento (collection_code) ao hash do seu conteúdo e guarda, por coleção,
+    a data do último evento do histórico de alterações do Article Meta já
+    processado.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._objects = os.path.join(path, OBJECTS_DIR)
+        self._index_file = os.path.join(path, INDEX_FILE)
+        self._pending = 0
+
+        if not os.path.exists(self._objects):
+            os.makedirs(self._objects)
+
+        self._index = self._load_index()
+
+    def _load_index(self):
+
+        if not os.path.exists(self._index_file):
+            return {
+                'synced_at': {},
+                'documents': {}
+            }
+
+        with open(self._index_file, 'r') as f:
+            index = json.load(f)
+
+        # Indexes written before the cutoff was kept by collection.
+        if not isinstance(index.get('synced_at'), dict):
+            index['synced_at'] = {}
+
+        return index
+
+    def _key(self, code, collection):
+
+        return '_'.join([collection, code])
+
+    def _object_path(self, digest):
+
+        return os.path.join(self._objects, digest[0:2], digest[2:] + '.xml.gz')
+
+    def save(self):
+        """
+        Grava o índice em disco de forma atômica.
+        """
+        tmp = self._index_file + '.tmp'
+
+        with open(tmp, 'w') as f:
+            json.dump(self._index, f)
+
+        os.rename(tmp, self._index_file)
+        self._pending = 0
+
+    def get(self, code, collection):
+        """
+        Retorna o XML do documento espelhado ou None caso o documento não
+        esteja no espelho.
+        """
+        digest = self._index['documents'].get(self._key(code, collection))
+
+        if not digest:
+            return None
+
+        try:
+            with open(self._object_path(digest), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    xml = zlib.decompress(mm, 16 + zlib.MAX_WBITS)
+                finally:
+                    mm.close()
+        except (IOError, OSError, ValueError, zlib.error):
+            logger.warning('Could not read mirrored XML for: %s_%s' % (
+                collection, code))
+            return None
+
+        return xml.decode('utf-8')
+
+    def put(self, code, collection, xml):
+        """
+        Armazena o XML do documento no espelho.
+        """
+        data = xml.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        object_path = self._object_path(digest)
+
+        if not os.path.exists(object_path):
+            shard = os.path.dirname(object_path)
+            if not os.path.exists(shard):
+                os.makedirs(shard)
+
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+                gz.write(data)
+
+            tmp = object_path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(buf.getvalue())
+            os.rename(tmp, object_path)
+
+        self._index['documents'][self._key(code, collection)] = digest
+
+        self._pending += 1
+        if self._pending >= FLUSH_EVERY:
+            self.save()
+
+    def remove(self, code, collection):
+
+        self._index['documents'].pop(self._key(code, collection), None)
+
+    def sync(self, articlemeta, collection=None):
+        """
+        Atualiza os documentos espelhados que sofreram alterações no Article
+        Meta desde a última sincronização. Documentos removidos no Article
+        Meta são retirados do espelho.
+
+        A data de corte da próxima sincronização é a data do último evento
+        recebido, atribuída pelo próprio Article Meta, e é mantida por coleção.
+        Na primeira execução de cada coleção todo o histórico é percorrido
+        apenas para obter essa data.
+        """
+        scope = collection or '*'
+        synced_at = self._index['synced_at'].get(scope)
+
+        for event in articlemeta.document_history_changes(
+                collection=collection, from_date=synced_at):
+
+            key = self._key(event.code, event.collection)
+
+            if synced_at is None or event.date > synced_at:
+                synced_at = event.date
+
+            if event.event == 'delete':
+                logger.debug('Removing mirrored XML for: %s' % key)
+                self.remove(event.code, event.collection)
+                continue
+
+            if key not in self._index['documents']:
+                continue
+
+            logger.debug('Refreshing mirrored XML for: %s' % key)
+            xml = articlemeta.document(
+                event.code, event.collection, fmt='xmlrsps')
+
+            if not xml:
+                self.remove(event.code, event.collection)
+                continue
+
+            self.put(event.code, event.collection, xml)
+
+        self._index['synced_at'][scope] = synced_at
+        self.save()
+
+    def document(self, articlemeta, code, collection):
+        """
+        Retorna o XML do documento a partir do espelho, recuperando-o do
+        Article Meta quando não estiver espelhado.
+        """
+        xml = self.get(code, collection)
+
+        if xml is not None:
+            return xml
+
+        xml = articlemeta.document(code, collection, fmt='xmlrsps')
+
+        if xml:
+            self.put(code, collection, xml)
+
+        return xml
@@ -1,6 +1,9 @@
 # coding: utf-8
 import os
 from celery import Celery
+from celery.signals import worker_process_shutdown
+from kombu import Exchange, Queue
+from kombu.utils import uuid
 import logging
 import time
 
@@ -8,6 +11,7 @@ import thriftpy
 from thriftpy.rpc import make_client
 
 import utils
+from thrift import clients
 
 logger = logging.getLogger(__name__)
 
@@ -17,17 +21,120 @@ scielomanager_thrift = thriftpy.load(
 celery_broker = utils.settings.get('celery', 'amqp://guest@localhost//')
 app = Celery('tasks', broker=celery_broker)
 
+REGISTRY_QUEUE = 'registry'
+IN_FLIGHT_TIMEOUT = 600
 
-@app.task
+PRIORITY_CLASSES = {
+    'high': 9,
+    'normal': 5,
+    'low': 1
+}
+
+app.conf.update(
+    CELERY_QUEUES=(
+        Queue(
+            REGISTRY_QUEUE,
+            routing_key=REGISTRY_QUEUE,
+            queue_arguments={'x-max-priority': 10}
+        ),
+    ),
+    CELERY_ROUTES={
+        'tasks.check_registry_status': {
+            'queue': REGISTRY_QUEUE,
+            'routing_key': REGISTRY_QUEUE
+        }
+    },
+    # Workers must not hold a backlog of prefetched messages, otherwise the
+    # message priorities are not honored. Late acknowledgement is not used:
+    # check_registry_status sends the XML to SciELO Manager, and a message
+    # redelivered after a worker crash would register it again.
+    CELERYD_PREFETCH_MULTIPLIER=1
+)
+
+
+class InFlight(object):
+    '''
+    Limita o número de tarefas enviadas por um produtor e ainda não concluídas
+    pelos workers.
+
+    Cada tarefa concluída publica uma mensagem na fila de notificação
+    exclusiva do produtor (``notify_queue``). Caso nenhuma tarefa seja
+    concluída em ``timeout`` segundos, uma tarefa é considerada perdida e sua
+    vaga é liberada.
+    '''
+
+    def __init__(self, limit, timeout=IN_FLIGHT_TIMEOUT):
+        if limit < 1:
+            raise ValueError('limit must be 1 or greater')
+
+        self.limit = limit
+        self.timeout = timeout
+        self.pending = 0
+        self.notify_queue = '%s.done.%s' % (REGISTRY_QUEUE, uuid())
+        self._connection = app.connection()
+        self._queue = self._connection.SimpleQueue(Queue(
+            self.notify_queue,
+            Exchange(''),
+            routing_key=self.notify_queue,
+            durable=False,
+            exclusive=True,
+            auto_delete=True
+        ))
+
+    def acquire(self):
+        while self.pending >= self.limit:
+            try:
+                message = self._queue.get(block=True, timeout=self.timeout)
+            except self._queue.Empty:
+                logger.warning('No registry task finished in %d seconds, assuming one was lost' % self.timeout)
+            else:
+                message.ack()
+
+            self.pending -= 1
+
+        self.pending += 1
+
+    def close(self):
+        self._queue.close()
+        self._connection.release()
+
+
+def _notify(queue):
+    if not queue:
+        return
+
+    with app.producer_or_acquire() as producer:
+        producer.publish(
+            {}, exchange='', routing_key=queue, serializer='json', retry=True)
+
+
+@worker_process_shutdown.connect
+def log_circuit_breaker_metrics(**kwargs):
+
+    for name, metrics in clients.circuit_breakers_metrics().items():
+        logger.info('Circuit breaker metrics for %s: %s' % (name, metrics))
+
+
+@app.task(bind=True, max_retries=None)
 def check_registry_status(
+        self,
         scielomanger_thrift_server,
         articlemeta_thrift_server,
-        data,
-        xml):
+        code,
+        collection,
+        xml,
+        task_id=None,
+        notify=None):
     '''
     Esta função é uma Celery Task que controla os eventos de registro de um
     XML no SciELO Manager.
     Em caso de sucesso o AID é registrado no Article Meta para referência.
+
+    Enquanto um dos servidores estiver indisponível (disjuntor aberto) a
+    tarefa é reagendada. O ``task_id`` do SciELO Manager, quando já obtido, é
+    repassado para que o XML não seja enviado novamente.
+
+    Ao final, o produtor é avisado por meio da fila ``notify`` (InFlight).
     '''
 
     status = [
@@ -38,22 +145,36 @@ def check_registry_status(
         'SUCCESS'
     ]
 
-    task_id = scielomanger_thrift_server.client.addArticle(xml)
+    try:
+        if task_id is None:
+            task_id = scielomanger_thrift_server.client.addArticle(xml)
+
+        while True:
+            result = scielomanger_thrift_server.client.getTaskResult(task_id)
 
-    while True:
-        result = scielomanger_thrift_server.client.getTaskResult(task_id)
+            if result.status in [0, 1, 2]:
+                logger.warning('XML loading status is %s for %s' % (status[result.status], code))
+                time.sleep(1)
+                continue
 
-        if result.status in [0, 1, 2]:
-            logger.warning('XML loading status is %s for %s' % (status[result.status], data.publisher_id))
-            time.sleep(1)
-            continue
+            if result.status == 4:
+                logger.info('XML loading status is %s for %s' % (status[result.status], code))
 
-        if result.status == 4:
-            logger.info('XML loading status is %s for %s' % (status[result.status], data.publisher_id))
+                articlemeta_thrift_server.client.set_aid(
+                    code, collection, result.value)
+                break
 
-            articlemeta_thrift_server.client.set_aid(
-                data.publisher_id, data.collection_acronym, result.value)
+            logger.warning('XML loading status is %s for %s (%s)' % (status[result.status], code, result.value))
             break
+    except clients.CircuitOpenError as exc:
+        logger.warning('Upstream server unavailable, retrying %s: %s' % (code, exc.message))
+        raise self.retry(
+            kwargs={'task_id': task_id, 'notify': notify},
+            exc=exc,
+            countdown=scielomanger_thrift_server.breaker.reset_timeout
+        )
+    except Exception:
+        _notify(notify)
+        raise
 
-        logger.warning('XML loading status is %s for %s (%s)' % (status[result.status], data.publisher_id, result.value))
-        break
+    _notify(notify)
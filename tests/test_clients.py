@@ -0,0 +1,324 @@
+# coding: utf-8
+import threading
+import unittest
+from collections import namedtuple
+
+from thrift.clients import (
+    ArticlesIndex, ScannedArticle, CircuitBreaker, CircuitOpenError,
+    ClientPool, PoolTimeoutError, ScieloManager)
+
+
+def article(aid, pid, epub='1234-5678', ppub=None, volume='10', issue='1'):
+
+    return ScannedArticle(aid, None, pid, epub, ppub, volume, issue)
+
+
+class ScieloManagerStub(object):
+
+    def __init__(self, articles):
+        self.articles = articles
+        self.scans = 0
+        self.queries = []
+
+    def scan_articles(self, query):
+        self.scans += 1
+        self.queries.append(query)
+        return iter(self.articles)
+
+
+class ArticlesIndexTests(unittest.TestCase):
+
+    def test_match_by_pid(self):
+        index = ArticlesIndex(ScieloManagerStub([
+            article('aid1', 'S1234-56782010000100001'),
+            article('aid2', 'S1234-56782010000100002'),
+        ]))
+
+        self.assertEqual(
+            index.match('1234-5678', '10', 'S1234-56782010000100002'), 'aid2')
+
+    def test_volume_mismatch_still_matches(self):
+        index = ArticlesIndex(ScieloManagerStub([
+            article('aid1', 'S1234-56782010000100001', volume='010'),
+        ]))
+
+        self.assertEqual(
+            index.match('1234-5678', '11', 'S1234-56782010000100001'), 'aid1')
+
+    def test_issue_is_not_part_of_the_key(self):
+        index = ArticlesIndex(ScieloManagerStub([
+            article('aid1', 'S1234-56782010000500001', issue='1 Suppl 2'),
+        ]))
+
+        self.assertEqual(
+            index.match('1234-5678', '10', 'S1234-56782010000500001'), 'aid1')
+
+    def test_duplicated_pid_is_not_matched(self):
+        index = ArticlesIndex(ScieloManagerStub([
+            article('aid1', 'S1234-56782010000100001'),
+            article('aid2', 'S1234-56782010000100001'),
+        ]))
+
+        self.assertIsNone(
+            index.match('1234-5678', '10', 'S1234-56782010000100001'))
+
+    def test_articles_of_other_journals_are_ignored(self):
+        index = ArticlesIndex(ScieloManagerStub([
+            article('aid1', 'S8765-43212010000100001', epub='1234-5678'),
+        ]))
+
+        self.assertIsNone(
+            index.match('1234-5678', '10', 'S8765-43212010000100001'))
+
+    def test_epub_ppub_other_than_pid_issn(self):
+        index = ArticlesIndex(ScieloManagerStub([
+            article('aid1', 'S1234-56782010000100001', epub='8765-4321', ppub='1111-2222'),
+        ]))
+
+        self.assertEqual(
+            index.match('1234-5678', '10', 'S1234-56782010000100001'), 'aid1')
+
+    def test_query_selects_articles_by_pid(self):
+        manager = ScieloManagerStub([])
+        ArticlesIndex(manager).match('1234-5678', '10', 'S1234-56782010000100001')
+
+        should = manager.queries[0]['query']['bool']['should']
+
+        self.assertIn({'prefix': {'pid': 'S1234-5678'}}, should)
+        self.assertNotIn('match', [list(clause)[0] for clause in should])
+
+    def test_issn_is_loaded_once(self):
+        manager = ScieloManagerStub([
+            article('aid1', 'S1234-56782010000100001'),
+        ])
+        index = ArticlesIndex(manager)
+
+        index.match('1234-5678', '10', 'S1234-56782010000100001')
+        index.match('1234-5678', '10', 'S1234-56782010000100002')
+
+        self.assertEqual(manager.scans, 1)
+
+
+def probe_ok():
+    pass
+
+
+def probe_fail():
+    raise IOError('connection refused')
+
+
+class CircuitBreakerTests(unittest.TestCase):
+
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker('host:1', failure_threshold=2, reset_timeout=60)
+
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker('host:1', failure_threshold=2, reset_timeout=60)
+
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_open_rejects_calls(self):
+        breaker = CircuitBreaker('host:1', failure_threshold=1, reset_timeout=60)
+        breaker.failure()
+
+        self.assertRaises(CircuitOpenError, breaker.before_call, probe_ok)
+        self.assertEqual(breaker.metrics()['rejected'], 1)
+
+    def test_successful_probe_closes(self):
+        breaker = CircuitBreaker('host:1', failure_threshold=1, reset_timeout=0)
+        breaker.failure()
+
+        breaker.before_call(probe_ok)
+
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.metrics()['transitions'], {
+            'closed -> open': 1,
+            'open -> half-open': 1,
+            'half-open -> closed': 1
+        })
+
+    def test_failed_probe_opens_again(self):
+        breaker = CircuitBreaker('host:1', failure_threshold=1, reset_timeout=0)
+        breaker.failure()
+
+        self.assertRaises(CircuitOpenError, breaker.before_call, probe_fail)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(breaker.metrics()['transitions']['half-open -> open'], 1)
+
+
+class TransportStub(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ThriftClientStub(object):
+
+    def __init__(self):
+        self.trans = TransportStub()
+        self._iprot = self
+
+
+class ClientPoolStub(ClientPool):
+
+    def __init__(self, size, timeout=1):
+        super(ClientPoolStub, self).__init__(
+            None, 'host', 1, size=size, timeout=timeout)
+        self.created = []
+
+    def _make_client(self):
+        client = ThriftClientStub()
+        self.created.append(client)
+        return client
+
+
+class ClientPoolTests(unittest.TestCase):
+
+    def test_connections_are_reused(self):
+        pool = ClientPoolStub(size=2)
+
+        with pool.connection() as first:
+            pass
+
+        with pool.connection() as second:
+            pass
+
+        self.assertIs(first, second)
+        self.assertEqual(len(pool.created), 1)
+
+    def test_waits_for_a_free_connection(self):
+        pool = ClientPoolStub(size=1, timeout=5)
+        checked_out = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with pool.connection():
+                checked_out.set()
+                release.wait()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        checked_out.wait()
+
+        threading.Timer(0.1, release.set).start()
+        with pool.connection():
+            pass
+
+        thread.join()
+        self.assertEqual(len(pool.created), 1)
+
+    def test_timeout_when_all_connections_are_in_use(self):
+        pool = ClientPoolStub(size=1, timeout=0.01)
+
+        with pool.connection():
+            self.assertRaises(
+                PoolTimeoutError, pool.connection().__enter__)
+
+    def test_failed_connection_is_discarded(self):
+        pool = ClientPoolStub(size=1)
+
+        try:
+            with pool.connection():
+                raise IOError('broken pipe')
+        except IOError:
+            pass
+
+        with pool.connection():
+            pass
+
+        self.assertTrue(pool.created[0].trans.closed)
+        self.assertEqual(len(pool.created), 2)
+
+
+ManagerArticle = namedtuple(
+    'ManagerArticle',
+    ['aid', 'doi', 'pid', 'epub', 'ppub', 'volume', 'issue', 'links_to', 'timestamp'])
+
+Batch = namedtuple('Batch', ['articles', 'next_batch_id'])
+
+
+def manager_article(aid):
+
+    return ManagerArticle(
+        aid, '10.1590/x', 'S1234-5678', '1234-5678', None, '1', '2', [], '2016')
+
+
+class JournalManagerStub(object):
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.batch_calls = []
+
+    def scanArticles(self, query):
+        return '0'
+
+    def getScanArticlesBatch(self, batch_id):
+        self.batch_calls.append(batch_id)
+        index = int(batch_id)
+
+        if index >= len(self.batches):
+            return Batch(None, None)
+
+        return Batch(self.batches[index], str(index + 1))
+
+
+class ScieloManagerClientStub(ScieloManager):
+
+    def __init__(self, batches):
+        super(ScieloManagerClientStub, self).__init__('host', 1)
+        self.stub = JournalManagerStub(batches)
+
+    @property
+    def client(self):
+        return self.stub
+
+
+class ScanTests(unittest.TestCase):
+
+    def test_doi_single_hit(self):
+        manager = ScieloManagerClientStub([[manager_article('aid1')]])
+
+        self.assertEqual(manager.retrieve_aid_from_doi('10.1590/x'), 'aid1')
+
+    def test_doi_stops_after_second_hit(self):
+        manager = ScieloManagerClientStub([
+            [manager_article('aid1')],
+            [manager_article('aid2')],
+            [manager_article('aid3')],
+            [manager_article('aid4')],
+        ])
+
+        self.assertIsNone(manager.retrieve_aid_from_doi('10.1590/x'))
+        self.assertEqual(manager.stub.batch_calls, ['0', '1'])
+
+    def test_doi_without_hits(self):
+        manager = ScieloManagerClientStub([])
+
+        self.assertIsNone(manager.retrieve_aid_from_doi('10.1590/x'))
+
+    def test_scan_keeps_only_scanned_fields(self):
+        manager = ScieloManagerClientStub([
+            [manager_article('aid1'), manager_article('aid2')],
+            [manager_article('aid3')],
+        ])
+
+        articles = list(manager.scan_articles({}))
+
+        self.assertEqual([a.aid for a in articles], ['aid1', 'aid2', 'aid3'])
+        for article in articles:
+            self.assertIsInstance(article, ScannedArticle)
+            self.assertFalse(hasattr(article, 'links_to'))
+        self.assertEqual(manager.stub.batch_calls, ['0', '1', '2'])
@@ -0,0 +1,105 @@
+# coding: utf-8
+import io
+import argparse
+import unittest
+
+from lxml import etree
+
+import exporter
+
+JATS = u"""<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE article PUBLIC "-//NLM//DTD JATS (Z39.96) Journal Publishing DTD v1.0 20120330//EN" "JATS-journalpublishing1.dtd">
+<article xmlns:xlink="http://www.w3.org/1999/xlink" article-type="research-article" dtd-version="1.0" specific-use="sps-1.1" xml:lang="en">
+<front>
+<journal-meta>
+<journal-id journal-id-type="publisher-id">abc</journal-id>
+<issn pub-type="epub">1234-5678</issn>
+</journal-meta>
+<article-meta>
+<article-id pub-id-type="publisher-id">S1234-56782010000100001</article-id>
+%s
+</article-meta>
+</front>
+</article>
+"""
+
+PUB_DATE = u"""<pub-date pub-type="epub-ppub"><month>03</month><year>2010</year></pub-date>"""
+
+SUMMARY_KEYS = set([
+    'dtd_is_valid', 'sps_is_valid', 'is_valid', 'document_type',
+    'publication_year'])
+
+
+class ValidatorStub(object):
+
+    def __init__(self, xml, sps_version=None):
+        if not isinstance(xml, type(u'')):
+            xml = xml.read()
+
+        self.lxml = etree.parse(io.BytesIO(xml.encode('utf-8')))
+
+    def validate(self):
+        return True, []
+
+    def validate_style(self):
+        return True, []
+
+
+class ExtractMetadataTests(unittest.TestCase):
+
+    def test_document_type_and_year(self):
+        metadata = exporter.extract_metadata(ValidatorStub(JATS % PUB_DATE))
+
+        self.assertEqual(metadata, {
+            'document_type': 'research-article',
+            'publication_year': '2010'
+        })
+
+    def test_without_pub_date(self):
+        metadata = exporter.extract_metadata(ValidatorStub(JATS % u''))
+
+        self.assertEqual(metadata['document_type'], 'research-article')
+        self.assertIsNone(metadata['publication_year'])
+
+
+class AnalyzeXMLTests(unittest.TestCase):
+
+    def setUp(self):
+        self._validator = exporter.packtools.XMLValidator
+
+    def tearDown(self):
+        exporter.packtools.XMLValidator = self._validator
+
+    def test_parsing_error(self):
+        exporter.packtools.XMLValidator = ValidatorStub
+
+        summary = exporter.analyze_xml(u'<article', 'S1234-56782010000100001')
+
+        self.assertEqual(set(summary), SUMMARY_KEYS | set(['parsing_error']))
+        self.assertTrue(summary['parsing_error'])
+        self.assertFalse(summary['is_valid'])
+        self.assertIsNone(summary['document_type'])
+        self.assertIsNone(summary['publication_year'])
+
+    def test_parsed(self):
+        exporter.packtools.XMLValidator = ValidatorStub
+
+        summary = exporter.analyze_xml(JATS % PUB_DATE, 'S1234-56782010000100001')
+
+        self.assertEqual(
+            set(summary), SUMMARY_KEYS | set(['dtd_errors', 'sps_errors']))
+        self.assertTrue(summary['is_valid'])
+        self.assertEqual(summary['document_type'], 'research-article')
+        self.assertEqual(summary['publication_year'], '2010')
+
+
+class PositiveIntTests(unittest.TestCase):
+
+    def test_accepts_positive(self):
+
+        self.assertEqual(exporter._positive_int('3'), 3)
+
+    def test_rejects_zero_and_negative(self):
+
+        self.assertRaises(argparse.ArgumentTypeError, exporter._positive_int, '0')
+        self.assertRaises(argparse.ArgumentTypeError, exporter._positive_int, '-5')
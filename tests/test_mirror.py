@@ -0,0 +1,145 @@
+# coding: utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from collections import namedtuple
+
+from mirror import XMLMirror
+
+Event = namedtuple('Event', ['code', 'collection', 'event', 'date'])
+
+
+class ArticleMetaStub(object):
+
+    def __init__(self, events=None):
+        self.events = events or []
+        self.fetched = []
+        self.from_dates = []
+
+    def document(self, code, collection, fmt='xylose'):
+        self.fetched.append((code, collection))
+        return u'<article>%s ç</article>' % code
+
+    def document_history_changes(self, collection=None, from_date=None):
+        self.from_dates.append(from_date)
+        return iter([e for e in self.events if
+                     (collection is None or e.collection == collection) and
+                     (from_date is None or e.date >= from_date)])
+
+
+class XMLMirrorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_put_and_get(self):
+        mirror = XMLMirror(self.path)
+        mirror.put('S0001', 'scl', u'<article>ç</article>')
+
+        self.assertEqual(mirror.get('S0001', 'scl'), u'<article>ç</article>')
+
+    def test_get_not_mirrored(self):
+        mirror = XMLMirror(self.path)
+
+        self.assertIsNone(mirror.get('S0001', 'scl'))
+
+    def test_same_content_is_stored_once(self):
+        mirror = XMLMirror(self.path)
+        mirror.put('S0001', 'scl', u'<article/>')
+        mirror.put('S0002', 'scl', u'<article/>')
+
+        objects = []
+        for _, _, files in os.walk(os.path.join(self.path, 'objects')):
+            objects.extend(files)
+
+        self.assertEqual(len(objects), 1)
+
+    def test_index_is_persisted(self):
+        mirror = XMLMirror(self.path)
+        mirror.put('S0001', 'scl', u'<article/>')
+        mirror.save()
+
+        self.assertEqual(XMLMirror(self.path).get('S0001', 'scl'), u'<article/>')
+
+    def test_document_fetches_only_once(self):
+        articlemeta = ArticleMetaStub()
+        mirror = XMLMirror(self.path)
+
+        mirror.document(articlemeta, 'S0001', 'scl')
+        xml = mirror.document(articlemeta, 'S0001', 'scl')
+
+        self.assertEqual(xml, u'<article>S0001 ç</article>')
+        self.assertEqual(articlemeta.fetched, [('S0001', 'scl')])
+
+    def test_sync_refreshes_only_mirrored_documents(self):
+        mirror = XMLMirror(self.path)
+        mirror.put('S0001', 'scl', u'<article>old</article>')
+        articlemeta = ArticleMetaStub([
+            Event('S0001', 'scl', 'update', '2016-01-02T10:00:00'),
+            Event('S0002', 'scl', 'update', '2016-01-02T11:00:00'),
+        ])
+
+        mirror.sync(articlemeta, 'scl')
+
+        self.assertEqual(articlemeta.fetched, [('S0001', 'scl')])
+        self.assertEqual(mirror.get('S0001', 'scl'), u'<article>S0001 ç</article>')
+        self.assertIsNone(mirror.get('S0002', 'scl'))
+
+    def test_sync_removes_deleted_documents(self):
+        mirror = XMLMirror(self.path)
+        mirror.put('S0001', 'scl', u'<article/>')
+        articlemeta = ArticleMetaStub([
+            Event('S0001', 'scl', 'delete', '2016-01-02T10:00:00'),
+        ])
+
+        mirror.sync(articlemeta, 'scl')
+
+        self.assertIsNone(mirror.get('S0001', 'scl'))
+
+    def test_sync_cutoff_is_the_last_event_date(self):
+        articlemeta = ArticleMetaStub([
+            Event('S0001', 'scl', 'add', '2016-01-03T10:00:00'),
+            Event('S0002', 'scl', 'add', '2016-01-02T10:00:00'),
+        ])
+
+        XMLMirror(self.path).sync(articlemeta, 'scl')
+        XMLMirror(self.path).sync(articlemeta, 'scl')
+
+        self.assertEqual(articlemeta.from_dates, [None, '2016-01-03T10:00:00'])
+
+    def test_sync_without_events_keeps_cutoff(self):
+        articlemeta = ArticleMetaStub([
+            Event('S0001', 'scl', 'add', '2016-01-03T10:00:00'),
+        ])
+        XMLMirror(self.path).sync(articlemeta, 'scl')
+
+        articlemeta.events = []
+        XMLMirror(self.path).sync(articlemeta, 'scl')
+        XMLMirror(self.path).sync(articlemeta, 'scl')
+
+        self.assertEqual(articlemeta.from_dates[-1], '2016-01-03T10:00:00')
+
+    def test_sync_cutoff_is_kept_by_collection(self):
+        mirror = XMLMirror(self.path)
+        mirror.put('S0001', 'scl', u'<article>old</article>')
+        articlemeta = ArticleMetaStub([
+            Event('S0001', 'scl', 'add', '2016-01-01T10:00:00'),
+            Event('A0001', 'arg', 'add', '2016-01-01T12:00:00'),
+        ])
+
+        mirror.sync(articlemeta, 'scl')
+        mirror.sync(articlemeta, 'arg')
+
+        # Updated in scl after the first scl sync, before the arg sync.
+        articlemeta.events.append(
+            Event('S0001', 'scl', 'update', '2016-01-01T11:00:00'))
+        articlemeta.fetched = []
+        mirror.sync(articlemeta, 'scl')
+
+        self.assertEqual(articlemeta.from_dates[-1], '2016-01-01T10:00:00')
+        self.assertEqual(articlemeta.fetched[-1], ('S0001', 'scl'))
+        self.assertEqual(mirror.get('S0001', 'scl'), u'<article>S0001 ç</article>')
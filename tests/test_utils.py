@@ -0,0 +1,35 @@
+# coding: utf-8
+import unittest
+
+import utils
+
+
+class RoundRobinTests(unittest.TestCase):
+
+    def test_interleaves_items(self):
+        result = list(utils.round_robin([[1, 2, 3], ['a', 'b'], ['x']]))
+
+        self.assertEqual(result, [1, 'a', 'x', 2, 'b', 3])
+
+    def test_skips_empty_iterables(self):
+        result = list(utils.round_robin([[], [1, 2], []]))
+
+        self.assertEqual(result, [1, 2])
+
+    def test_consumes_generators_lazily(self):
+        consumed = []
+
+        def gen(name):
+            for i in range(3):
+                consumed.append((name, i))
+                yield (name, i)
+
+        iterator = utils.round_robin([gen('a'), gen('b')])
+        next(iterator)
+        next(iterator)
+
+        self.assertEqual(consumed, [('a', 0), ('b', 0)])
+
+    def test_no_iterables(self):
+
+        self.assertEqual(list(utils.round_robin([])), [])
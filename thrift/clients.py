@@ -1,13 +1,26 @@
 # coding: utf-8
 import os
 import json
+import time
 import logging
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
 
 import thriftpy
 from thriftpy.rpc import make_client
 from xylose.scielodocument import Article, Journal
 
 LIMIT = 1000
+POOL_SIZE = 10
+POOL_TIMEOUT = 60
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
 
 logger = logging.getLogger(__name__)
 
@@ -26,25 +39,416 @@ class ServerError(Exception):
         return repr(self.message)
 
 
-class ScieloManager(object):
+class CircuitOpenError(ServerError):
+    pass
+
+
+def _close(client):
+    # thriftpy's TClient has no close method, close its transport instead.
+    client._iprot.trans.close()
+
+
+class CircuitBreaker(object):
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
 
-    def __init__(self, address, port):
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
         """
-        Cliente thrift para o SciELO Manager.
+        Disjuntor de um servidor thrift.
+
+        Após ``failure_threshold`` falhas consecutivas as chamadas passam a ser
+        recusadas imediatamente (CircuitOpenError). Passados ``reset_timeout``
+        segundos, uma chamada de teste (probe) decide se o servidor voltou a
+        responder.
         """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+        self.transitions = {}
+        self.rejected = 0
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+
+        logger.warning('Circuit breaker for %s: %s -> %s' % (
+            self.name, self.state, state))
+
+        key = '%s -> %s' % (self.state, state)
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        self.state = state
+
+        if state == self.OPEN:
+            self._opened_at = time.time()
+
+    def before_call(self, probe):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+
+            if self.state == self.OPEN and time.time() - self._opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+            else:
+                self.rejected += 1
+                raise CircuitOpenError(
+                    'Circuit breaker open for %s' % self.name)
+
+        try:
+            probe()
+        except Exception:
+            self.failure()
+            raise CircuitOpenError(
+                'Circuit breaker open for %s, probe failed' % self.name)
+
+        self.success()
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._set_state(self.CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._set_state(self.OPEN)
+
+    def metrics(self):
+
+        return {
+            'state': self.state,
+            'rejected': self.rejected,
+            'transitions': dict(self.transitions)
+        }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(address, port, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+    """
+    Retorna o disjuntor compartilhado por todos os clientes do mesmo servidor.
+    """
+    name = '%s:%s' % (address, port)
+
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(
+                name, failure_threshold, reset_timeout)
+
+    return _breakers[name]
+
+
+def circuit_breakers_metrics():
+    """
+    Retorna as métricas dos disjuntores criados neste processo.
+    """
+    with _breakers_lock:
+        return dict([(name, breaker.metrics()) for name, breaker in _breakers.items()])
+
+
+class PoolTimeoutError(ServerError):
+    pass
+
+
+class ClientPool(object):
+
+    def __init__(self, service, address, port, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        """
+        Mantém até ``size`` conexões thrift abertas para reutilização entre
+        chamadas, inclusive entre threads. Com ``size`` conexões em uso, as
+        chamadas aguardam até ``timeout`` segundos por uma conexão livre.
+        """
+        self._service = service
         self._address = address
         self._port = port
+        self._size = size
+        self._timeout = timeout
+        self._open = 0
+        self._lock = threading.Lock()
+        self._clients = Queue(maxsize=size)
+
+    def _make_client(self):
+
+        return make_client(self._service, self._address, self._port)
+
+    def _acquire(self):
+        try:
+            return self._clients.get_nowait()
+        except Empty:
+            pass
+
+        with self._lock:
+            create = self._open < self._size
+            if create:
+                self._open += 1
+
+        if not create:
+            try:
+                return self._clients.get(timeout=self._timeout)
+            except Empty:
+                raise PoolTimeoutError(
+                    'No thrift connection available for %s:%s' % (
+                        self._address, self._port))
+
+        try:
+            return self._make_client()
+        except:
+            with self._lock:
+                self._open -= 1
+            raise
+
+    def _discard(self, client):
+        with self._lock:
+            self._open -= 1
+
+        _close(client)
+
+    @contextmanager
+    def connection(self):
+        client = self._acquire()
+
+        try:
+            yield client
+        except:
+            # The socket may be in an inconsistent state, do not reuse it.
+            self._discard(client)
+            raise
+
+        self._clients.put_nowait(client)
+
+    def close(self):
+        while True:
+            try:
+                self._discard(self._clients.get_nowait())
+            except Empty:
+                break
+
+
+class PooledClient(object):
+
+    def __init__(self, pool, breaker, probe, expected_errors=()):
+        """
+        Proxy para os métodos do serviço thrift, onde cada chamada utiliza uma
+        conexão do pool e é controlada pelo disjuntor do servidor.
+
+        ``expected_errors`` são exceções que indicam erro na requisição e não
+        problemas no servidor, portanto não contam como falha para o disjuntor.
+        """
+        self._pool = pool
+        self._breaker = breaker
+        self._probe = probe
+        self._expected_errors = expected_errors
+
+    def __getattr__(self, name):
+
+        def call(*args, **kwargs):
+            self._breaker.before_call(self._probe)
+
+            try:
+                with self._pool.connection() as client:
+                    result = getattr(client, name)(*args, **kwargs)
+            except PoolTimeoutError:
+                # A busy pool says nothing about the server health.
+                raise
+            except self._expected_errors:
+                self._breaker.success()
+                raise
+            except Exception:
+                self._breaker.failure()
+                raise
+
+            self._breaker.success()
+
+            return result
+
+        return call
+
+
+class ThriftClient(object):
+
+    service = None
+    probe_method = None
+    expected_errors = ()
+
+    def __init__(self, address, port, pool_size=POOL_SIZE,
+                 failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self._address = address
+        self._port = port
+        self._pool_size = pool_size
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._pool = None
+        self._lock = threading.Lock()
+        self.breaker = circuit_breaker(
+            address, port, failure_threshold, reset_timeout)
+
+    def __getstate__(self):
+        # Pools and locks can not be pickled (Celery task arguments).
+        return {
+            'address': self._address,
+            'port': self._port,
+            'pool_size': self._pool_size,
+            'failure_threshold': self._failure_threshold,
+            'reset_timeout': self._reset_timeout
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _probe(self):
+        with self._pool.connection() as client:
+            getattr(client, self.probe_method)()
 
     @property
     def client(self):
 
-        client = make_client(
-            scielomanager_thrift.JournalManagerServices,
-            self._address,
-            self._port
-        )
+        with self._lock:
+            if self._pool is None:
+                self._pool = ClientPool(
+                    self.service,
+                    self._address,
+                    self._port,
+                    size=self._pool_size
+                )
+
+        return PooledClient(
+            self._pool, self.breaker, self._probe, self.expected_errors)
+
+
+ScannedArticle = namedtuple(
+    'ScannedArticle', ['aid', 'doi', 'pid', 'epub', 'ppub', 'volume', 'issue'])
+
+
+def _normalize(value):
+    """
+    Normaliza volume e número do fascículo para comparação.
+    """
+    if not value:
+        return ''
+
+    value = value.strip().lower()
+
+    return value.lstrip('0') or value
+
+
+class ArticlesIndex(object):
+
+    def __init__(self, scielomanager):
+        """
+        Índice local dos artigos do SciELO Manager, agrupados por ISSN e
+        indexados por PID.
+        """
+        self._scielomanager = scielomanager
+        self._issns = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _query(self, issn):
+        # PIDs start with the journal's SciELO ISSN. The ISSN fields are kept
+        # as a fallback, as phrases, so that the ISSN halves are not matched
+        # on their own.
+        return {
+            "query": {
+                "bool": {
+                    "should": [
+                        {"prefix": {"pid": "S%s" % issn}},
+                        {"match_phrase": {"epub": issn}},
+                        {"match_phrase": {"ppub": issn}}
+                    ]
+                }
+            }
+        }
+
+    def _build(self, issn, articles):
+
+        entries = {}
+        for article in articles:
+
+            # The ISSN fields may hold another journal's ISSN, the PID decides.
+            if not article.pid or article.pid[1:10].upper() != issn:
+                continue
+
+            if issn not in [(i or '').upper() for i in (article.epub, article.ppub)]:
+                logger.warning('ISSN mismatch for PID %s: %s not in (%s, %s)' % (
+                    article.pid, issn, article.epub, article.ppub))
+
+            # More than one article for the same PID is not a precise match.
+            entries[article.pid] = None if article.pid in entries else (
+                article.aid, article.volume)
+
+        logger.info('SciELO Manager index loaded for ISSN %s: %d articles' % (
+            issn, len(entries)))
+
+        return entries
+
+    def _load(self, issn):
+
+        return self._build(
+            issn, self._scielomanager.scan_articles(self._query(issn)))
+
+    def _entries(self, issn):
+        """
+        Retorna o índice do ISSN, carregando-o quando necessário. Cada ISSN é
+        carregado sob o seu próprio lock, sem bloquear os demais.
+        """
+        with self._lock:
+            if issn in self._issns:
+                return self._issns[issn]
+
+            lock = self._locks.setdefault(issn, threading.Lock())
+
+        with lock:
+            with self._lock:
+                if issn in self._issns:
+                    return self._issns[issn]
+
+            entries = self._load(issn)
+
+            with self._lock:
+                self._issns[issn] = entries
+
+        return entries
+
+    def match(self, issn, volume, pid):
+        entries = self._entries(issn.upper())
+
+        if pid not in entries:
+            return None
+
+        if entries[pid] is None:
+            logger.warning('Not a precise match, more than one document found for PID: %s' % pid)
+            return None
 
-        return client
+        aid, indexed_volume = entries[pid]
+
+        if _normalize(volume) != _normalize(indexed_volume):
+            logger.warning('Volume mismatch for PID %s: %s, SciELO Manager: %s' % (
+                pid, volume, indexed_volume))
+
+        return aid
+
+
+class ScieloManager(ThriftClient):
+
+    service = scielomanager_thrift.JournalManagerServices
+    probe_method = 'getInterfaceVersion'
+    expected_errors = (scielomanager_thrift.BadRequestError,)
+
+    def __init__(self, address, port, **kwargs):
+        """
+        Cliente thrift para o SciELO Manager.
+        """
+        super(ScieloManager, self).__init__(address, port, **kwargs)
+        self._articles_index = None
 
     def retrieve_aid_from_doi(self, doi):
         """
@@ -59,9 +463,29 @@ class ScieloManager(object):
             }
         }
 
+        aids = []
+        for article in self.scan_articles(query):
+            aids.append(article.aid)
+
+            # A second hit already proves the match is ambiguous.
+            if len(aids) > 1:
+                logger.warning('Not a precise match, more than one document found for DOI: %s' % doi)
+                return None
+
+        if len(aids) == 1:
+            return aids[0]
+
+        logger.warning('Not a precise match, no document found for DOI: %s' % doi)
+
+    def scan_articles(self, query):
+        """
+        Itera sobre os artigos do SciELO Manager que atendem a consulta
+        (Query DSL do Elasticsearch), um lote por vez.
+
+        Apenas os campos de ScannedArticle são mantidos.
+        """
         batch_id = self.client.scanArticles(json.dumps(query))
 
-        articles = []
         while True:
 
             data = self.client.getScanArticlesBatch(batch_id)
@@ -70,42 +494,60 @@ class ScieloManager(object):
                 break
 
             for article in data.articles:
-                articles.append(article)
+                yield ScannedArticle(*[getattr(article, f) for f in ScannedArticle._fields])
 
             batch_id = data.next_batch_id
 
-        if len(articles) == 1:
-            return articles[0].aid
-
-        logger.warning('Not a precise match, %d documents found for DOI: %s' % (len(articles), doi))
-
-    def retrieve_aid_from_meta(self, issn, volume, issue, title, fpage=None, elocation=None):
+    def retrieve_aid_from_meta(self, issn, volume, pid):
         """
         Metodo que recupera o AID quando existir no SciELO Manager de acordo com
         os metadados indicados.
+
+        A consulta é feita em um índice local, carregado uma única vez por
+        ISSN, evitando consultas ao SciELO Manager para cada documento.
         """
+        return self.articles_index.match(issn, volume, pid)
+
+    @property
+    def articles_index(self):
 
-        pass
+        with self._lock:
+            if self._articles_index is None:
+                self._articles_index = ArticlesIndex(self)
 
+        return self._articles_index
 
-class ArticleMeta(object):
 
-    def __init__(self, address, port):
+class ArticleMeta(ThriftClient):
+
+    service = articlemeta_thrift.ArticleMeta
+    probe_method = 'get_collection_identifiers'
+    expected_errors = (articlemeta_thrift.ValueError,)
+
+    def __init__(self, address, port, **kwargs):
         """
         Cliente thrift para o Articlemeta.
         """
-        self._address = address
-        self._port = port
+        super(ArticleMeta, self).__init__(address, port, **kwargs)
 
-    @property
-    def client(self):
+    def journal_identifiers(self, collection=None):
+        """
+        Itera sobre os identificadores (journal_identifiers) dos periódicos,
+        sem recuperar os periódicos propriamente ditos.
+        """
+        offset = 0
+        while True:
+            identifiers = self.client.get_journal_identifiers(
+                collection=collection, limit=LIMIT, offset=offset)
 
-        client = make_client(
-            articlemeta_thrift.ArticleMeta,
-            self._address,
-            self._port
-        )
-        return client
+            if len(identifiers) == 0:
+                raise StopIteration
+
+            for identifier in identifiers:
+
+                yield identifier
+
+            offset += 1000
 
     def journals(self, collection=None, issn=None):
         offset = 0
@@ -138,6 +580,8 @@ class ArticleMeta(object):
                 code,
                 collection
             )
+        except CircuitOpenError:
+            raise
         except:
             msg = 'Error checking if document exists: %s_%s' % (
                 collection, code)
@@ -150,6 +594,8 @@ class ArticleMeta(object):
                 collection,
                 doaj_id
             )
+        except CircuitOpenError:
+            raise
         except:
             msg = 'Error senting doaj id for document: %s_%s' % (
                 collection, code)
@@ -164,6 +610,8 @@ class ArticleMeta(object):
                 replace_journal_metadata=True,
                 fmt=fmt
             )
+        except CircuitOpenError:
+            raise
         except:
             msg = 'Error retrieving document: %s_%s' % (collection, code)
             raise ServerError(msg)
@@ -188,7 +636,11 @@ class ArticleMeta(object):
         logger.info('Document loaded: %s_%s' % (collection, code))
         return article
 
-    def documents(self, collection=None, issn=None, from_date=None, until_date=None, fmt='xylose', extra_filter=None):
+    def identifiers(self, collection=None, issn=None, from_date=None, until_date=None, extra_filter=None):
+        """
+        Itera sobre os identificadores (article_identifiers) dos documentos,
+        sem recuperar os documentos propriamente ditos.
+        """
         offset = 0
         while True:
             identifiers = self.client.get_article_identifiers(
@@ -201,14 +653,50 @@ class ArticleMeta(object):
 
             for identifier in identifiers:
 
-                document = self.document(
-                    code=identifier.code,
-                    collection=identifier.collection,
-                    replace_journal_metadata=True,
-                    fmt=fmt
-                )
+                yield identifier
+
+            offset += 1000
+
+    def documents(self, collection=None, issn=None, from_date=None, until_date=None, fmt='xylose', extra_filter=None):
+
+        for identifier in self.identifiers(
+                collection=collection, issn=issn, from_date=from_date,
+                until_date=until_date, extra_filter=extra_filter):
+
+            document = self.document(
+                code=identifier.code,
+                collection=identifier.collection,
+                replace_journal_metadata=True,
+                fmt=fmt
+            )
+
+            yield document
+
+    def document_history_changes(self, collection=None, event=None, code=None, from_date=None, until_date=None):
+        """
+        Itera sobre os eventos (add, update, delete) registrados para os
+        documentos no periodo indicado.
+        """
+        offset = 0
+        while True:
+            try:
+                events = self.client.article_history_changes(
+                    collection=collection, event=event, code=code,
+                    from_date=from_date, until_date=until_date,
+                    limit=LIMIT, offset=offset)
+            except CircuitOpenError:
+                raise
+            except:
+                msg = 'Error retrieving document history changes: %s' % (
+                    collection)
+                raise ServerError(msg)
+
+            if len(events) == 0:
+                raise StopIteration
+
+            for item in events:
 
-                yield document
+                yield item
 
             offset += 1000
 
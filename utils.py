@@ -95,7 +95,40 @@ def ckeck_given_issns(issns):
     return valid_issns
 
 
-def articlemeta_server():
+def round_robin(iterables):
+    """
+    Intercala os itens dos iteráveis, um de cada vez, até que todos se
+    esgotem.
+    """
+    iterators = [iter(i) for i in iterables]
+
+    while iterators:
+        for iterator in list(iterators):
+            try:
+                yield next(iterator)
+            except StopIteration:
+                iterators.remove(iterator)
+
+
+def circuit_breaker_settings():
+    options = {}
+
+    try:
+        options['failure_threshold'] = int(
+            settings['app:main']['circuit_breaker_failure_threshold'])
+    except KeyError:
+        pass
+
+    try:
+        options['reset_timeout'] = int(
+            settings['app:main']['circuit_breaker_reset_timeout'])
+    except KeyError:
+        pass
+
+    return options
+
+
+def articlemeta_server(**kwargs):
     try:
         server = settings['app:main']['articlemeta_thriftserver'].split(':')
         host = server[0]
@@ -105,10 +138,13 @@ def articlemeta_server():
         host = 'articlemeta.scielo.org'
         port = 11720
 
-    return clients.ArticleMeta(host, port)
+    options = circuit_breaker_settings()
+    options.update(kwargs)
+
+    return clients.ArticleMeta(host, port, **options)
 
 
-def scielomanager_server():
+def scielomanager_server(**kwargs):
     try:
         server = settings['app:main']['scielomanager_thriftserver'].split(':')
         host = server[0]
@@ -118,4 +154,7 @@ def scielomanager_server():
         host = 'scielomanager.scielo.org'
         port = 11720
 
-    return clients.ScieloManager(host, port)
\ No newline at end of file
+    options = circuit_breaker_settings()
+    options.update(kwargs)
+
+    return clients.ScieloManager(host, port, **options)
\ No newline at end of file